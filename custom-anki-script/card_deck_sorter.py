@@ -2,10 +2,20 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import functools
+import itertools
 import json
 import sys
-import urllib.request
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # optional: much faster JSON encode/decode
+except ImportError:
+    orjson = None
 
 ANKI_CONNECT_URL = "http://127.0.0.1:8765"
 
@@ -23,18 +33,46 @@ ONLY_MOVE_IF_CURRENT_DECK_IS = "Default"
 DECK_PREFIX_FILTER = "1. VOCABULARY::02. 30 Chủ đề (full)"
 
 CARDSINFO_BATCH = 200
+
+# Sub-actions sent per AnkiConnect `multi` request.
+MULTI_BATCH = 20
 # ------------------------
 
+# One keep-alive session for every AnkiConnect call (avoids a new TCP connection per request).
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    # Connection errors and 502/503/504 are retried with backoff (AnkiConnect only takes POST).
+    # read=0: a request that already reached Anki and timed out is not sent again.
+    max_retries=Retry(total=3, read=0, backoff_factor=0.3, status_forcelist=[502, 503, 504],
+                      allowed_methods=["POST"]),
+))
+
+
+def json_dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
+def json_loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode("utf-8"))
+
 
 def anki_invoke(action: str, params: Optional[Dict[str, Any]] = None) -> Any:
     payload = {"action": action, "version": 6, "params": params or {}}
-    data = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(
-        ANKI_CONNECT_URL, data=data, headers={"Content-Type": "application/json"}
-    )
     try:
-        with urllib.request.urlopen(req, timeout=60) as resp:
-            out = json.loads(resp.read().decode("utf-8"))
+        r = _SESSION.post(
+            ANKI_CONNECT_URL,
+            data=json_dumps(payload),
+            headers={"Content-Type": "application/json"},
+            timeout=60,
+        )
+        r.raise_for_status()
+        out = json_loads(r.content)
     except Exception as e:
         raise RuntimeError(
             "Cannot reach AnkiConnect at {0}. Is Anki open and AnkiConnect installed?\n{1}".format(
@@ -46,80 +84,138 @@ def anki_invoke(action: str, params: Optional[Dict[str, Any]] = None) -> Any:
     return out.get("result")
 
 
-def deck_names() -> List[str]:
-    return anki_invoke("deckNames")
-
-
-def create_deck(deck: str) -> None:
-    anki_invoke("createDeck", {"deck": deck})
+def anki_multi(actions: List[Dict[str, Any]]) -> List[Any]:
+    """Run several actions in one AnkiConnect `multi` request; returns their results in order."""
+    if not actions:
+        return []
+    subs = [
+        {"action": a["action"], "version": 6, "params": a.get("params", {})} for a in actions
+    ]
+    replies = anki_invoke("multi", {"actions": subs})
+    out: List[Any] = []
+    for a, reply in zip(actions, replies):
+        if reply.get("error") is not None:
+            raise RuntimeError("AnkiConnect error on {0}: {1}".format(a["action"], reply["error"]))
+        out.append(reply.get("result"))
+    return out
 
 
-def find_notes(query: str) -> List[int]:
-    return anki_invoke("findNotes", {"query": query})
+def anki_multi_batched(actions: List[Dict[str, Any]]) -> List[Any]:
+    out: List[Any] = []
+    for sub in chunks(actions, MULTI_BATCH):
+        out.extend(anki_multi(sub))
+    return out
 
 
-def notes_info(note_ids: List[int]) -> List[Dict[str, Any]]:
-    return anki_invoke("notesInfo", {"notes": note_ids})
+@functools.lru_cache(maxsize=1)
+def deck_names() -> List[str]:
+    # Cached for the whole run; do not mutate the returned list.
+    return anki_invoke("deckNames")
 
 
-def cards_info(card_ids: List[int]) -> List[Dict[str, Any]]:
-    return anki_invoke("cardsInfo", {"cards": card_ids})
+def create_deck(deck: str) -> None:
+    anki_invoke("createDeck", {"deck": deck})
 
 
 def change_deck(card_ids: List[int], deck: str) -> None:
     anki_invoke("changeDeck", {"cards": card_ids, "deck": deck})
 
 
-def chunks(xs: List[int], n: int) -> List[List[int]]:
-    return [xs[i : i + n] for i in range(0, len(xs), n)]
+def chunks(xs: Iterable[Any], n: int) -> Iterator[List[Any]]:
+    it = iter(xs)
+    while True:
+        batch = list(itertools.islice(it, n))
+        if not batch:
+            return
+        yield batch
 
 
 def is_source_deck(name: str, prefix: str) -> bool:
-    if SOURCE_SEGMENT not in name:
-        return False
+    # Cheap prefix test first; most decks outside the prefix are rejected without a substring scan.
     if prefix and not name.startswith(prefix):
         return False
-    return True
+    return SOURCE_SEGMENT in name
 
 
 def map_deck(src: str) -> str:
     return src.replace(SOURCE_SEGMENT, TARGET_SEGMENT, 1)
 
 
-def get_note_ids_in_deck(deck: str) -> List[int]:
-    q = 'deck:"{0}"'.format(deck)
-    return find_notes(q)
+def route_notes(
+    src_decks: List[str],
+    members: Dict[str, Set[int]],
+    ex_members: Dict[str, Set[int]],
+    last_wins: bool,
+) -> Dict[int, str]:
+    """
+    noteId -> source deck whose target its exercise card ends up in.
+
+    Replays moving deck by deck in sorted order, where deck:"X" also covers X's subdecks.
+    `members[X]` are notes in X through cards that never move; `ex_members[X]` are notes in X
+    through their exercise card, which stops counting once that card has been moved.
+    With the safety deck on the first deck claims a card (it has left the safety deck);
+    without it (last_wins) every later deck containing the note moves it again.
+    """
+    out: Dict[int, str] = {}
+    moved: Set[int] = set()
+    for deck in sorted(src_decks):
+        matched = members.get(deck, set()) | (ex_members.get(deck, set()) - moved)
+        for nid in matched:
+            if last_wins or nid not in out:
+                out[nid] = deck
+        moved |= matched
+    return out
 
 
-def get_all_card_ids_from_notes(note_ids: List[int]) -> List[int]:
-    if not note_ids:
-        return []
-    infos = notes_info(note_ids)
-    out: List[int] = []
-    for n in infos:
-        out.extend(n.get("cards", []))
-    return out
+def map_notes_to_source_decks(
+    src_decks: List[str], exercise_ord: int, last_wins: bool
+) -> Dict[int, str]:
+    """noteId -> source deck, from two id-only findNotes per source deck (no cardsInfo)."""
+    card = "card:{0}".format(exercise_ord + 1)
+    actions: List[Dict[str, Any]] = []
+    for d in src_decks:
+        for q in ('deck:"{0}" -{1}'.format(d, card), 'deck:"{0}" {1}'.format(d, card)):
+            actions.append({"action": "findNotes", "params": {"query": q}})
+    results = anki_multi_batched(actions)
+
+    members: Dict[str, Set[int]] = {}
+    ex_members: Dict[str, Set[int]] = {}
+    for i, d in enumerate(src_decks):
+        members[d] = set(results[2 * i])
+        ex_members[d] = set(results[2 * i + 1])
+    return route_notes(src_decks, members, ex_members, last_wins)
+
+
+def exercise_query(note_ids: List[int], exercise_ord: int, only_if_deck: Optional[str]) -> str:
+    # card:N is the 1-based template number; deck:"X" also matches subdecks, so exclude them.
+    q = "nid:{0} card:{1}".format(",".join(str(n) for n in note_ids), exercise_ord + 1)
+    if only_if_deck is not None:
+        q += ' deck:"{0}" -deck:"{0}::*"'.format(only_if_deck)
+    return q
 
 
 def collect_exercise_cards_by_ord(
-    card_ids: List[int],
+    note_to_deck: Dict[int, str],
     exercise_ord: int,
     only_if_deck: Optional[str],
-) -> List[int]:
-    if not card_ids:
-        return []
-
-    selected: List[int] = []
-    for batch in chunks(card_ids, CARDSINFO_BATCH):
-        infos = cards_info(batch)
-        for c in infos:
-            # ord is 0-based card template index
-            if c.get("ord") != exercise_ord:
-                continue
-            curr_deck = c.get("deckName", "")
-            if only_if_deck is not None and curr_deck != only_if_deck:
-                continue
-            selected.append(c["cardId"])
+) -> Dict[str, List[int]]:
+    """Source deck -> ids of cards to move. Anki does the ord/deck filtering, so no cardsInfo."""
+    notes_by_deck: Dict[str, List[int]] = {}
+    for nid, deck in note_to_deck.items():
+        notes_by_deck.setdefault(deck, []).append(nid)
+
+    owners: List[str] = []
+    actions: List[Dict[str, Any]] = []
+    for deck, note_ids in notes_by_deck.items():
+        for batch in chunks(note_ids, CARDSINFO_BATCH):
+            owners.append(deck)
+            q = exercise_query(batch, exercise_ord, only_if_deck)
+            actions.append({"action": "findCards", "params": {"query": q}})
+
+    selected: Dict[str, List[int]] = {}
+    for deck, card_ids in zip(owners, anki_multi_batched(actions)):
+        if card_ids:
+            selected.setdefault(deck, []).extend(card_ids)
     return selected
 
 
@@ -142,7 +238,7 @@ def main() -> int:
     anki_invoke("version")
 
     decks = deck_names()
-    src_decks = [d for d in decks if is_source_deck(d, prefix)]
+    src_decks = sorted(d for d in decks if is_source_deck(d, prefix))
 
     print("[INFO] Source decks found: {0}".format(len(src_decks)))
     if prefix:
@@ -154,21 +250,17 @@ def main() -> int:
     else:
         print("[WARN] Safety disabled: moving matching ord cards regardless of current deck.")
 
+    note_to_deck = map_notes_to_source_decks(src_decks, exercise_ord, last_wins=only_from is None)
+    ex_card_ids_by_deck = collect_exercise_cards_by_ord(note_to_deck, exercise_ord, only_from)
+
+    existing_decks = set(decks)
     total_planned = 0
     total_moved = 0
 
-    for src in sorted(src_decks):
+    for src in src_decks:
         tgt = map_deck(src)
 
-        note_ids = get_note_ids_in_deck(src)
-        if not note_ids:
-            continue
-
-        card_ids = get_all_card_ids_from_notes(note_ids)
-        if not card_ids:
-            continue
-
-        ex_card_ids = collect_exercise_cards_by_ord(card_ids, exercise_ord, only_from)
+        ex_card_ids = ex_card_ids_by_deck.get(src, [])
         if not ex_card_ids:
             continue
 
@@ -178,7 +270,9 @@ def main() -> int:
             print("[DRY] move={0} | {1} -> {2}".format(len(ex_card_ids), src, tgt))
             continue
 
-        create_deck(tgt)
+        if tgt not in existing_decks:
+            create_deck(tgt)
+            existing_decks.add(tgt)
         change_deck(ex_card_ids, tgt)
         total_moved += len(ex_card_ids)
         print("[MOVE] moved={0} | {1} -> {2}".format(len(ex_card_ids), src, tgt))
@@ -2,11 +2,28 @@
 # Python 3.9 compatible
 
 import argparse
+import functools
+import hashlib
+import itertools
+import json
 import os
 import re
 import subprocess
 import requests
-from typing import Any, Dict, List, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # optional, faster JSON for large notesInfo payloads
+except ImportError:
+    orjson = None
+
+try:
+    import ijson  # optional, parse notesInfo incrementally instead of all at once
+except ImportError:
+    ijson = None
 
 ANKI_CONNECT_URL = "http://127.0.0.1:8765"
 
@@ -14,19 +31,94 @@ FIELD_X_DEFAULT = "Synonyms"
 FIELD_Y_DEFAULT = "Synonyms IPA"   # kept for backward-compat, not used
 FIELD_Z_DEFAULT = "Synonyms"
 
+IPA_CACHE_DEFAULT = os.path.expanduser("~/.cache/anki_ipa_cache.json")
+ESPEAK_BATCH = 500   # items transcribed per espeak process
+UPDATE_MULTI_BATCH_DEFAULT = 500   # updateNoteFields sub-actions per multi request
+
+# Reuse one keep-alive connection for all AnkiConnect calls.
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    # Retry connection errors and 502/503/504 with backoff instead of aborting the run.
+    # read=0: never resend a request that reached Anki but timed out (e.g. a big write).
+    max_retries=Retry(total=3, read=0, backoff_factor=0.3, status_forcelist=[502, 503, 504],
+                      allowed_methods=["POST"]),
+))
+
+
+def json_dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
 
-def anki_invoke(action: str, params: Optional[Dict[str, Any]] = None) -> Any:
+def json_loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _iter_result_items(action: str, resp: Any) -> Iterator[Any]:
+    """Yield the items of a response's `result` array while it is still being parsed."""
+    errors: List[Any] = []
+
+    def events() -> Iterator[Any]:
+        # `error` follows `result` in AnkiConnect replies; note it on the way through.
+        for prefix, event, value in ijson.parse(resp.raw, use_float=True):
+            if prefix == "error" and value is not None:
+                errors.append(value)
+            yield prefix, event, value
+
+    try:
+        yield from ijson.items(events(), "result.item")
+        if errors:
+            raise RuntimeError(f"{action}: {errors[0]}")
+    finally:
+        resp.close()   # give the keep-alive connection back to the pool
+
+
+def anki_invoke(action: str, params: Optional[Dict[str, Any]] = None, stream: bool = False) -> Any:
+    """
+    With stream=True the (list) result comes back as an iterator parsed while it downloads.
+    Without ijson installed it falls back to a plain iterator over the parsed list.
+    """
     payload = {"action": action, "version": 6, "params": params or {}}
-    r = requests.post(ANKI_CONNECT_URL, json=payload, timeout=60)
+    use_ijson = stream and ijson is not None
+    r = _SESSION.post(ANKI_CONNECT_URL, data=json_dumps(payload),
+                      headers={"Content-Type": "application/json"}, timeout=60,
+                      stream=use_ijson)
     r.raise_for_status()
-    data = r.json()
+    if use_ijson:
+        r.raw.decode_content = True
+        return _iter_result_items(action, r)
+    data = json_loads(r.content)
     if data.get("error"):
         raise RuntimeError(data["error"])
-    return data["result"]
+    return iter(data["result"]) if stream else data["result"]
+
 
+def anki_multi(actions: List[Dict[str, Any]]) -> List[Any]:
+    """Run several actions in a single `multi` request and return their results in order."""
+    if not actions:
+        return []
+    subs = [{"action": a["action"], "version": 6, "params": a.get("params", {})} for a in actions]
+    replies = anki_invoke("multi", {"actions": subs})
+    out: List[Any] = []
+    for a, reply in zip(actions, replies):
+        if reply.get("error"):
+            raise RuntimeError(f"{a['action']}: {reply['error']}")
+        out.append(reply.get("result"))
+    return out
 
-def chunked(lst: List[int], size: int) -> List[List[int]]:
-    return [lst[i: i + size] for i in range(0, len(lst), size)]
+
+def chunked(lst: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    it = iter(lst)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
 
 
 def build_query(deck_root: Optional[str], note_type: Optional[str]) -> str:
@@ -42,7 +134,9 @@ def build_query(deck_root: Optional[str], note_type: Optional[str]) -> str:
 # IPA via system espeak
 # -------------------------
 
-_ZERO_WIDTH_RE = re.compile(r"[\u200b\u200c\u200d\ufeff]")  # ZWSP, ZWNJ, ZWJ, BOM
+_ZERO_WIDTH = "\u200b\u200c\u200d\ufeff"  # ZWSP, ZWNJ, ZWJ, BOM
+_WS_RE = re.compile(r"\s+")
+_CLEAN_RE = re.compile(r"[\s\u200b\u200c\u200d\ufeff]+")  # whitespace and zero-width runs
 
 
 def _resolve_espeak_cmd() -> List[str]:
@@ -61,54 +155,202 @@ def _build_env() -> Dict[str, str]:
     return env
 
 
+def _clean_run(m: "re.Match[str]") -> str:
+    return " " if m.group(0).strip(_ZERO_WIDTH) else ""
+
+
 def clean_ipa(s: str, strip_zero_width: bool) -> str:
     s = s or ""
     if strip_zero_width:
-        s = _ZERO_WIDTH_RE.sub("", s)
-    s = " ".join(s.split())
+        # One pass: runs containing whitespace become a space, pure zero-width runs vanish.
+        s = _CLEAN_RE.sub(_clean_run, s)
+    else:
+        s = _WS_RE.sub(" ", s)
     return s.strip()
 
 
+def _espeak_voice(lang: str) -> str:
+    voice_map = {"en-us": "en-us", "en-gb": "en-gb"}
+    return voice_map.get(lang.lower(), lang)
+
+
 def ipa_of_text(text: str, lang: str = "en-us", *, strip_zero_width: bool = False) -> str:
     text = (text or "").strip()
     if not text:
         return ""
 
-    voice_map = {"en-us": "en-us", "en-gb": "en-gb"}
-    voice = voice_map.get(lang.lower(), lang)
-
-    cmd = _resolve_espeak_cmd() + ["-q", f"-v{voice}", "--ipa=3", text]
+    cmd = _resolve_espeak_cmd() + ["-q", f"-v{_espeak_voice(lang)}", "--ipa=3", text]
     env = _build_env()
 
     try:
-        out = subprocess.check_output(cmd, env=env, stderr=subprocess.STDOUT, text=True)
+        out = subprocess.check_output(cmd, env=env, stderr=subprocess.PIPE, text=True)
     except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"espeak failed: {e.output.strip()}") from e
+        raise RuntimeError(f"espeak failed: {(e.stderr or '').strip()}") from e
 
     return clean_ipa(out, strip_zero_width=strip_zero_width)
 
 
+# Written after every item of a batch; its IPA marks where that item's output ends.
+# The periods close the item's last clause and the sentinel's own clause.
+_SENTINEL_LINE = ". qxzqxzq."
+
+
+def _run_espeak_stdin(voice: str, text: str) -> str:
+    # -l: treat every (short) input line as the end of a clause.
+    cmd = _resolve_espeak_cmd() + ["-q", f"-v{voice}", "--ipa=3", "-l", "10000"]
+    try:
+        proc = subprocess.run(cmd, input=text, env=_build_env(), text=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"espeak failed: {(e.stderr or '').strip()}") from e
+    return proc.stdout
+
+
+@functools.lru_cache(maxsize=None)
+def _sentinel_ipa(voice: str) -> Optional[str]:
+    """espeak's output for _SENTINEL_LINE, or None if it is not exactly one non-empty line."""
+    out = _run_espeak_stdin(voice, _SENTINEL_LINE + "\n")
+    lines = [o for o in (" ".join(o.split()) for o in out.splitlines()) if o]
+    return lines[0] if len(lines) == 1 else None
+
+
+def _split_on_sentinel(out: str, sentinel: str) -> Optional[List[List[str]]]:
+    """Output lines grouped per item; None if anything follows the last sentinel."""
+    groups: List[List[str]] = []
+    current: List[str] = []
+    for o in out.splitlines():
+        o = " ".join(o.split())
+        if o == sentinel:
+            groups.append(current)
+            current = []
+        elif o:
+            current.append(o)
+    return None if current else groups
+
+
+def ipa_of_texts(
+    texts: List[str],
+    lang: str = "en-us",
+    *,
+    strip_zero_width: bool = False
+) -> List[str]:
+    """
+    IPA for many items with one espeak process. Each item is followed by a sentinel line and
+    the output is split on the sentinel's IPA, so items spanning several clauses (or none)
+    stay aligned. A batch that does not split into one group per item is halved and retried,
+    so only the offending items end up with an espeak call of their own.
+    """
+    if len(texts) <= 1:
+        return [ipa_of_text(t, lang=lang, strip_zero_width=strip_zero_width) for t in texts]
+
+    voice = _espeak_voice(lang)
+    sentinel = _sentinel_ipa(voice)
+    if sentinel is None:
+        return [ipa_of_text(t, lang=lang, strip_zero_width=strip_zero_width) for t in texts]
+
+    data = "".join(f"{' '.join((t or '').split())}\n{_SENTINEL_LINE}\n" for t in texts)
+    groups = _split_on_sentinel(_run_espeak_stdin(voice, data), sentinel)
+    if groups is None or len(groups) != len(texts):
+        mid = len(texts) // 2
+        return (ipa_of_texts(texts[:mid], lang=lang, strip_zero_width=strip_zero_width)
+                + ipa_of_texts(texts[mid:], lang=lang, strip_zero_width=strip_zero_width))
+    return [clean_ipa(" ".join(g), strip_zero_width=strip_zero_width) for g in groups]
+
+
+def ipa_key_prefix(lang: str, strip_zero_width: bool) -> str:
+    """Cache keys are ipa_key_prefix(...) + item."""
+    return f"{lang.lower()}|{int(strip_zero_width)}|"
+
+
+def split_items(x: str) -> List[str]:
+    return [p.strip() for p in (x or "").split(",") if p.strip()]
+
+
+IpaJob = Tuple[List[str], "Future[List[str]]"]
+
+
+def submit_ipa_jobs(
+    pool: ThreadPoolExecutor,
+    items: List[str],
+    *,
+    lang: str = "en-us",
+    strip_zero_width: bool = False,
+    size: int = ESPEAK_BATCH
+) -> List[IpaJob]:
+    """Start one espeak process per `size` items; results are picked up by collect_ipa_jobs."""
+    # espeak runs in its own process, so threads are enough to keep every core busy.
+    return [
+        (sub, pool.submit(ipa_of_texts, sub, lang=lang, strip_zero_width=strip_zero_width))
+        for sub in chunked(items, max(1, size))
+    ]
+
+
+def collect_ipa_jobs(jobs: List[IpaJob], cache: Dict[str, str], keypfx: str) -> None:
+    for sub, fut in jobs:
+        for item, ipa in zip(sub, fut.result()):
+            cache[keypfx + item] = ipa
+
+
+def load_ipa_cache(path: str) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Returns (ipa, note_hashes). Older cache files hold only the flat IPA map.
+    """
+    if not path or not os.path.isfile(path):
+        return {}, {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[WARN] Ignoring unreadable IPA cache {path}: {e}")
+        return {}, {}
+    if not isinstance(data, dict):
+        return {}, {}
+    if "ipa" not in data:
+        return data, {}
+    return data.get("ipa") or {}, data.get("notes") or {}
+
+
+def save_ipa_cache(path: str, cache: Dict[str, str], note_hashes: Dict[str, str]) -> None:
+    if not path:
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"ipa": cache, "notes": note_hashes}, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def note_digest(x: str, z: str) -> str:
+    """Short fingerprint of a note's (X, Z) values, used to skip notes already up to date."""
+    xh = hashlib.blake2b(x.encode("utf-8"), digest_size=8).hexdigest()
+    zh = hashlib.blake2b(z.encode("utf-8"), digest_size=8).hexdigest()
+    return f"{xh}:{zh}"
+
+
 def make_target_value(
     x: str,
     y: Optional[str],
     *,
     lang: str = "en-us",
     strip_zero_width: bool = False,
-    ipa_cache: Optional[Dict[str, str]] = None
+    ipa_cache: Optional[Dict[str, str]] = None,
+    items: Optional[List[str]] = None
 ) -> str:
     x = (x or "").strip()
     if not x:
         return ""
 
-    items = [p.strip() for p in x.split(",") if p.strip()]
+    if items is None:
+        items = split_items(x)
     if not items:
         return ""
 
     cache = ipa_cache if ipa_cache is not None else {}
+    keypfx = ipa_key_prefix(lang, strip_zero_width)
     ipa_items: List[str] = []
 
     for item in items:
-        k = f"{lang.lower()}|{int(strip_zero_width)}|{item}"
+        k = keypfx + item
         if k in cache:
             ipa = cache[k]
         else:
@@ -142,11 +384,19 @@ def main() -> None:
                     help='espeak voice, e.g. "en-us" or "en-gb". Default: en-us')
     ap.add_argument("--strip-zero-width", action="store_true",
                     help="Remove zero-width chars from IPA output.")
+    ap.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                    help="Parallel espeak processes. Default: CPU count.")
+    ap.add_argument("--ipa-cache", default=IPA_CACHE_DEFAULT,
+                    help=f'JSON file keeping IPA and per-note hashes across runs. '
+                         f'Default: {IPA_CACHE_DEFAULT}. "" disables.')
 
     ap.add_argument("--dry-run", action="store_true")
     ap.add_argument("--only-if-z-empty", action="store_true")
     ap.add_argument("--limit", type=int, default=0,
                     help="If > 0, only process first N matched notes (useful for testing).")
+    ap.add_argument("--multi-batch", type=int, default=UPDATE_MULTI_BATCH_DEFAULT,
+                    help="updateNoteFields actions per multi request. "
+                         f"Default: {UPDATE_MULTI_BATCH_DEFAULT}")
 
     args = ap.parse_args()
 
@@ -164,37 +414,89 @@ def main() -> None:
         note_ids = note_ids[:args.limit]
         print(f"[INFO] Limiting to first {len(note_ids)} notes")
 
-    BATCH = 200
-    ipa_cache: Dict[str, str] = {}
+    NOTESINFO_BATCH = 2000   # notes per streamed notesInfo request
+    ipa_cache, note_hashes = load_ipa_cache(args.ipa_cache)
     planned_updates: List[Dict[str, Any]] = []
 
-    for batch in chunked(note_ids, BATCH):
-        infos = anki_invoke("notesInfo", {"notes": batch})
-        for info in infos:
-            nid = info["noteId"]
-            fields = info.get("fields", {})
-
-            x = (fields.get(args.field_x, {}).get("value") or "").strip()
-            y = (fields.get(args.field_y, {}).get("value") or "").strip()
-            z = (fields.get(args.field_z, {}).get("value") or "").strip()
-
-            if args.only_if_z_empty and z:
-                continue
-            if not x:
-                continue
-
-            new_z = make_target_value(
-                x, y,
-                lang=args.lang,
-                strip_zero_width=args.strip_zero_width,
-                ipa_cache=ipa_cache
-            )
-
-            if new_z and new_z != z:
-                planned_updates.append({
-                    "id": nid,
-                    "fields": {args.field_z: new_z}
-                })
+    # Pass 1: fetch notes; tokenize each distinct X once and collect the unique items.
+    # Full espeak batches start as soon as they are known, so IPA generation for
+    # earlier notes overlaps with the notesInfo requests for later ones.
+    keypfx = ipa_key_prefix(args.lang, args.strip_zero_width)
+    note_keypfx = f"{keypfx}{args.field_x}|{args.field_z}|"
+    jobs = max(1, args.jobs)
+    skipped = 0
+    candidates: List[Tuple[int, str, str]] = []
+    items_by_x: Dict[str, List[str]] = {}
+    unique_items: Dict[str, None] = {}   # ordered set
+    to_transcribe: List[str] = []
+    ipa_jobs: List[IpaJob] = []
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for batch in chunked(note_ids, NOTESINFO_BATCH):
+            # Streamed: notes are filtered while the (HTML-heavy) response is parsed.
+            for info in anki_invoke("notesInfo", {"notes": batch}, stream=True):
+                nid = info["noteId"]
+                fields = info.get("fields", {})
+
+                x = (fields.get(args.field_x, {}).get("value") or "").strip()
+                z = (fields.get(args.field_z, {}).get("value") or "").strip()
+
+                if args.only_if_z_empty and z:
+                    continue
+                if not x:
+                    continue
+                if note_hashes.get(note_keypfx + str(nid)) == note_digest(x, z):
+                    skipped += 1   # unchanged since this run last wrote it
+                    continue
+
+                candidates.append((nid, x, z))
+                if x in items_by_x:
+                    continue
+                items_by_x[x] = split_items(x)
+                for item in items_by_x[x]:
+                    if item not in unique_items and keypfx + item not in ipa_cache:
+                        to_transcribe.append(item)
+                    unique_items[item] = None
+
+            full = len(to_transcribe) - len(to_transcribe) % ESPEAK_BATCH
+            if full:
+                ipa_jobs += submit_ipa_jobs(pool, to_transcribe[:full], lang=args.lang,
+                                            strip_zero_width=args.strip_zero_width)
+                del to_transcribe[:full]
+
+        # Spread the remainder over all workers.
+        ipa_jobs += submit_ipa_jobs(pool, to_transcribe, lang=args.lang,
+                                    strip_zero_width=args.strip_zero_width,
+                                    size=min(ESPEAK_BATCH, -(-len(to_transcribe) // jobs)))
+        print(f"[INFO] Unchanged since last run: {skipped} | unique items: {len(unique_items)} "
+              f"(espeak jobs: {jobs})")
+        collect_ipa_jobs(ipa_jobs, ipa_cache, keypfx)
+
+    # Pass 2: one target value per distinct X, then plain lookups per note.
+    new_z_by_x = {
+        x: make_target_value(
+            x, None,
+            lang=args.lang,
+            strip_zero_width=args.strip_zero_width,
+            ipa_cache=ipa_cache,
+            items=items
+        )
+        for x, items in items_by_x.items()
+    }
+    fresh_hashes: Dict[str, str] = {}
+    for nid, x, z in candidates:
+        new_z = new_z_by_x[x]
+        if new_z and new_z != z:
+            planned_updates.append({
+                "id": nid,
+                "fields": {args.field_z: new_z}
+            })
+        # Remember the values the note holds once updated (X is Z when both are the same field).
+        x_after = new_z if args.field_x == args.field_z else x
+        fresh_hashes[note_keypfx + str(nid)] = note_digest(x_after, new_z or z)
+
+    # IPA is kept even for dry runs; note fingerprints only once the notes really hold those values.
+    save_ipa_cache(args.ipa_cache, ipa_cache, note_hashes)
 
     print(f"[INFO] Notes to update: {len(planned_updates)}")
 
@@ -205,18 +507,22 @@ def main() -> None:
         return
 
     if not planned_updates:
+        note_hashes.update(fresh_hashes)
+        save_ipa_cache(args.ipa_cache, ipa_cache, note_hashes)
         print("[OK] Nothing to update.")
         return
 
     # Use AnkiConnect action: updateNoteFields (supported widely)
     # For speed, send in multi batches.
-    MULTI_BATCH = 50
-    for sub in chunked(planned_updates, MULTI_BATCH):
+    for sub in chunked(planned_updates, max(1, args.multi_batch)):
         actions = [
             {"action": "updateNoteFields", "params": {"note": u}}
             for u in sub
         ]
-        anki_invoke("multi", {"actions": actions})
+        anki_multi(actions)
+
+    note_hashes.update(fresh_hashes)
+    save_ipa_cache(args.ipa_cache, ipa_cache, note_hashes)
 
     print("[OK] Updated successfully.")
 